@@ -3,29 +3,72 @@
 import argparse
 import json
 import logging
-import math
 import os
+import queue
 import sys
+import threading
 import time
+from collections.abc import Callable, Iterable, Iterator
+from operator import itemgetter
+
+try:
+    import ijson  # optional, required for --stream
+except ImportError:
+    ijson = None
 
 LOG_FORMAT = "[%(asctime)s] [%(levelname)s]: %(message)s"
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 VALID_FIELDS = ["bannerUrl", "category", "description", "developer", "frontBoxArt", "iconUrl", "id", "intro", "isDemo", "key", "language", "languages", "name", "nsuId",
                 "numberOfPlayers", "publisher", "rank", "rating", "ratingContent", "region", "regions", "releaseDate", "rightsId", "screenshots", "size", "version"]
+VALID_FIELDS_SET = frozenset(VALID_FIELDS)
 
 logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt=DATE_FORMAT)
 
 
+def _select_json_library() -> tuple:
+    """Pick the fastest installed JSON library, falling back to the json module
+
+    The output is equivalent JSON with every library but not byte for byte the same, e.g. orjson and msgspec write non-ASCII
+    characters as UTF-8 while ujson and json escape them, and the libraries format some floats differently
+
+    Returns:
+        tuple: name of the library, a loads function, a dumps function returning compact JSON as bytes
+    """
+    try:
+        import orjson
+        return "orjson", orjson.loads, orjson.dumps
+    except ImportError:
+        pass
+
+    try:
+        import msgspec.json
+        return "msgspec", msgspec.json.decode, msgspec.json.encode
+    except ImportError:
+        pass
+
+    try:
+        import ujson
+        return "ujson", ujson.loads, lambda obj: ujson.dumps(obj, escape_forward_slashes=False).encode()
+    except ImportError:
+        pass
+
+    return "json", json.loads, lambda obj: json.dumps(obj, separators=(",", ":")).encode()  # use separators to remove whitespaces
+
+
+JSON_LIBRARY, _loads, _dumps = _select_json_library()
+
+
 def parse_args() -> argparse.Namespace:
     """Parse the arguments passed to the script
 
     Returns:
-        argparse.Namespace: Object containing output_file, input_file and fields arguments
+        argparse.Namespace: Object containing output_file, input_file, fields and stream arguments
     """
     parser = argparse.ArgumentParser(description="Reduce the size of the titleDB JSON file by removing entries without a name and only keeping the specified fields.")
     parser.add_argument("input_file", help="The JSON file to process")  # required argument
     parser.add_argument("-o", "--output_file", help="The file to output_file to. Defaults to the input file if not provided")  # optional arguments
     parser.add_argument("-f", "--fields", nargs="*", help="List of fields to keep in the output_file, defaults to all fields. Separate fields with a space e.g -f name description rating")
+    parser.add_argument("-s", "--stream", action="store_true", help="Trim the titles while the input file is being read instead of loading it all into memory first. Requires ijson")
     return parser.parse_args()
 
 
@@ -37,9 +80,9 @@ def validate_fields(fields: list):
     Args:
         fields (list): List of fields to validate
     """
-    if fields and not all(field in VALID_FIELDS for field in fields):
+    if fields and not VALID_FIELDS_SET.issuperset(fields):
         # if any of the fields are not valid, log an error and exit
-        invalid_fields = ', '.join(set(fields) - set(VALID_FIELDS))
+        invalid_fields = ', '.join(set(fields) - VALID_FIELDS_SET)
         logging.error(f"Invalid field [{invalid_fields}]. Valid fields are {', '.join(VALID_FIELDS)}")
         sys.exit(1)
 
@@ -60,53 +103,303 @@ def read_json_file(file_path: str) -> dict | None:
 
     try:
         # read the file and return the data
-        with open(file_path) as f:
-            return json.load(f)
-    except json.JSONDecodeError as e:
+        with open(file_path, "rb") as f:
+            return _loads(f.read())
+    except ValueError as e:  # every supported JSON library raises a subclass of ValueError for invalid JSON
+        # if the file is not a valid JSON file, log an error and exit
+        logging.error(f"{file_path} is not a valid JSON file. {e}")
+        sys.exit(1)
+
+
+def stream_json_file(file_path: str) -> Iterator[tuple[str, dict]]:
+    """Lazily read the entries of a JSON file one at a time
+
+    Args:
+        file_path (str): path to the file to read
+
+    Returns:
+        Iterator[tuple[str, dict]]: iterator of (title_id, title_data) pairs read from the file
+    """
+    if ijson is None:
+        # streaming relies on an incremental parser, log an error and exit if it is missing
+        logging.error("ijson is required to use --stream. Install it with pip install ijson")
+        sys.exit(1)
+
+    if not os.path.exists(file_path):
+        # if the file does not exist, log an error and exit
+        logging.error(f"File {file_path} does not exist")
+        sys.exit(1)
+
+    try:
+        with open(file_path, "rb") as f:
+            # only parses the first buffer of the file
+            _, event, _ = next(ijson.parse(f))
+    except ijson.JSONError as e:
         # if the file is not a valid JSON file, log an error and exit
         logging.error(f"{file_path} is not a valid JSON file. {e}")
         sys.exit(1)
+    if event != "start_map":
+        # kvitems yields nothing for anything other than an object, which would silently write an empty output_file
+        logging.error(f"{file_path} is not a valid titledb file, expected a JSON object")
+        sys.exit(1)
 
+    return _iter_json_items(file_path)
 
-def write_to_file(output_file: str, new_data: dict) -> None:
-    """Write a dictionary to a file as JSON
+
+class _ThreadedReader:
+    """Read a binary file in a background thread so reading from disk overlaps with parsing
+
+    Only implements the read() method used by ijson. The thread owns the file, call close() to stop it once reading is finished or abandoned
+    """
+
+    def __init__(self, file_path: str, chunk_size: int = 4 * 1024 * 1024, max_chunks: int = 8):
+        self._chunks = queue.Queue(maxsize=max_chunks)  # bounded so the thread stays at most max_chunks ahead of the parser
+        self._stop = threading.Event()
+        self._error = None
+        self._eof = False
+        self._thread = threading.Thread(target=self._read_chunks, args=(file_path, chunk_size), daemon=True)
+        self._thread.start()
+
+    def _read_chunks(self, file_path: str, chunk_size: int) -> None:
+        """Read the file into the queue until the end of the file is reached or close() is called
+
+        Args:
+            file_path (str): path to the file to read
+            chunk_size (int): number of bytes to read at a time
+        """
+        try:
+            with open(file_path, "rb") as f:
+                while not self._stop.is_set() and (chunk := f.read(chunk_size)):
+                    self._chunks.put(chunk)
+        except (OSError, ValueError) as e:
+            # pass the error on to the parser instead of silently ending the file early
+            self._error = e
+        finally:
+            self._chunks.put(b"")  # an empty chunk marks the end of the file
+
+    def read(self, size: int = -1) -> bytes:
+        """Return the next chunk read by the thread
+
+        The size requested is ignored, apart from 0, and whole chunks of up to chunk_size (4 MiB by default) are returned instead
+
+        Args:
+            size (int, optional): number of bytes requested. Defaults to -1.
+
+        Returns:
+            bytes: the next chunk of the file or an empty bytes object at the end of the file
+        """
+        if size == 0 or self._eof:
+            return b""
+        chunk = self._chunks.get()
+        if not chunk:
+            self._eof = True
+            if self._error is not None:
+                raise self._error
+        return chunk
+
+    def close(self) -> None:
+        """Stop the thread and wait for it to close the file"""
+        self._stop.set()
+        # empty the queue so a thread blocked on a full queue can finish, it adds at most two more chunks before exiting
+        while True:
+            try:
+                self._chunks.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
+
+
+def _iter_json_items(file_path: str) -> Iterator[tuple[str, dict]]:
+    """Parse the entries of a JSON object file one at a time
+
+    Args:
+        file_path (str): path to the file to read
+
+    Returns:
+        Iterator[tuple[str, dict]]: iterator of (title_id, title_data) pairs read from the file
+    """
+    reader = _ThreadedReader(file_path)
+    try:
+        # use_float returns numbers as floats instead of Decimal so they can be serialised again
+        yield from ijson.kvitems(reader, "", use_float=True)
+    except ijson.JSONError as e:
+        # if the file is not a valid JSON file, log an error and exit
+        logging.error(f"{file_path} is not a valid JSON file. {e}")
+        sys.exit(1)
+    except OSError as e:
+        # if the file could not be read, log an error and exit
+        logging.error(f"Error reading {file_path}. {e}")
+        sys.exit(1)
+    finally:
+        # stop the reader thread if parsing finished early, e.g. because of an error or the output failing to write
+        reader.close()
+
+
+def write_titles_to_file(output_file: str, titles: dict | Iterable[tuple[str, dict]]) -> int:
+    """Write titles to a file as a JSON object
+
+    The titles are written to a temporary file which then replaces output_file, so output_file may also be the file the titles are being read from
 
     Args:
         output_file (str): path to the file to write to
-        new_data (dict): data to write to the file
+        titles (dict | Iterable[tuple[str, dict]]): titles to write to the file, either a dictionary or (title_id, title_data) pairs
+
+    Returns:
+        int: number of titles written
     """
+    temp_file = f"{output_file}.tmp"
+    count = 0
     try:
-        # write the new data to the output_file file
-        with open(output_file, "w") as f:
-            json.dump(new_data, f, separators=(",", ":"))  # use separators to remove whitespaces
+        with open(temp_file, "wb", buffering=1 << 20) as f:
+            if JSON_LIBRARY != "json" and isinstance(titles, dict):
+                # the titles are already in memory, serialising them in a single call is faster than one title at a time
+                f.write(_dumps(titles))
+                count = len(titles)
+            else:
+                # serialise one title at a time into a large write buffer so only a single title is ever held as JSON
+                f.write(b"{")
+                for count, (title_id, title_data) in enumerate(titles.items() if isinstance(titles, dict) else titles, start=1):
+                    if count > 1:  # separate each title from the previous one
+                        f.write(b",")
+                    f.write(_dumps(title_id) + b":" + _dumps(title_data))
+                f.write(b"}")
+        os.replace(temp_file, output_file)
     except Exception as e:
         # if there is an error writing to the output_file file, log an error and exit
         logging.error(f"Error writing to {output_file}. {e}")
         sys.exit(1)
+    finally:
+        # remove the temporary file if it was not moved into place
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return count
+
+
+def _log_progress(items: Iterable, total: int | None = None, step: int = 10000) -> Iterator:
+    """Yield each item unchanged, logging progress every 10% or when the count reaches total
+
+    When total is not known, e.g. while streaming, progress is logged every step items and once all items have been processed instead
+
+    Args:
+        items (Iterable): items being processed
+        total (int | None, optional): number of items, or None if not known. Defaults to None.
+        step (int, optional): number of items between progress logs when total is not known. Defaults to 10000.
+
+    Returns:
+        Iterator: the same items
+    """
+    if total is None:
+        count = 0
+        for count, item in enumerate(items, start=1):
+            yield item
+
+            if count % step == 0:
+                logging.info(f"Progress: {count} titles")
+        if count % step:
+            logging.info(f"Progress: {count} titles")
+        return
+
+    step = total // 10 or 1  # number of items between progress logs
+    next_log = step
+    for count, item in enumerate(items, start=1):
+        yield item
+
+        # the item has been processed once the next one is requested
+        if count == next_log or count == total:
+            logging.info(f"Progress: {100 * count // total}% - {count}/{total}")
+            next_log += step
+
+
+def _title_trimmer(fields: list | None) -> Callable[[dict], dict | None]:
+    """Build the function that trims a single title, specialised once for the fields to keep
 
+    When fields is not provided, fields not in VALID_FIELDS are dropped and the remaining fields keep the order of the input file
 
-def trim_titledb(data: dict, fields: list) -> dict:
+    Args:
+        fields (list | None): fields to keep in the output_file, all valid fields are kept if not provided
+
+    Returns:
+        Callable[[dict], dict | None]: function returning the trimmed title, or None if the title has no name
+    """
+    if not fields:
+        def trim_title(title_data: dict) -> dict | None:
+            if not title_data.get("name"):  # only include titles with a name
+                return None
+            if title_data.keys() <= VALID_FIELDS_SET:
+                return title_data  # the title has no other fields so it is kept as is
+            return {field: value for field, value in title_data.items() if field in VALID_FIELDS_SET}
+        return trim_title
+
+    # fetch every field of a title in one call. The repeated first field makes itemgetter return a tuple even when
+    # only one field is given, zip() drops the extra value
+    get_fields = itemgetter(*fields, fields[0])
+
+    def trim_title(title_data: dict) -> dict | None:
+        if not title_data.get("name"):  # only include titles with a name
+            return None
+        try:
+            return dict(zip(fields, get_fields(title_data)))
+        except KeyError:
+            # the title is missing some of the fields, only include the ones it has
+            return {field: title_data[field] for field in fields if field in title_data}
+    return trim_title
+
+
+def trim_titledb(data: dict, fields: list | None) -> dict:
     """Trim titledb by removing entries without a name and only keeping the fields in the fields list
 
     Args:
         data (dict): title data to reduce
-        fields (list): fields to keep in the output_file
+        fields (list | None): fields to keep in the output_file, all valid fields are kept if not provided
 
     Returns:
         dict: reduced title data
     """
+    trim_title = _title_trimmer(fields)
     new_data = {}  # new dictionary to store the reduced data
-    for count, (title_id, title_data) in enumerate(data.items(), start=1):
-        if title_data.get("name"):  # only include titles with a name
-            # only include the fields that are in the fields list or all fields if fields not provided
-            new_data[title_id] = {field: title_data[field] for field in (fields or title_data) if field in title_data}
-
-        # log progress every 10% or when the count reaches the length of the data
-        if count % (((len(data) // 10)) if len(data) > 10 else 1) == 0 or count == len(data):
-            logging.info(f"Progress: {int(math.floor(count/len(data)*100))}% - {count}/{len(data)}")
+    for title_id, title_data in _log_progress(data.items(), len(data)):
+        if (trimmed := trim_title(title_data)) is not None:
+            new_data[title_id] = trimmed
     return new_data  # return the reduced data
 
 
+def trim_titledb_in_place(data: dict, fields: list | None) -> dict:
+    """Trim titledb in place by removing entries without a name and only keeping the fields in the fields list
+
+    Unlike trim_titledb, no second dictionary is built and each full title can be freed as soon as it has been trimmed
+
+    Args:
+        data (dict): title data to reduce, modified directly
+        fields (list | None): fields to keep in the output_file, all valid fields are kept if not provided
+
+    Returns:
+        dict: data, reduced
+    """
+    trim_title = _title_trimmer(fields)
+    for title_id in _log_progress(list(data), len(data)):  # iterate over a copy of the keys as titles are deleted
+        if (trimmed := trim_title(data[title_id])) is None:
+            del data[title_id]
+        else:
+            data[title_id] = trimmed
+    return data
+
+
+def trim_titles(titles: Iterable[tuple[str, dict]], fields: list | None) -> Iterator[tuple[str, dict]]:
+    """Trim titles as they are read by skipping entries without a name and only keeping the fields in the fields list
+
+    Args:
+        titles (Iterable[tuple[str, dict]]): (title_id, title_data) pairs to reduce
+        fields (list | None): fields to keep in the output_file, all valid fields are kept if not provided
+
+    Returns:
+        Iterator[tuple[str, dict]]: reduced (title_id, title_data) pairs
+    """
+    trim_title = _title_trimmer(fields)
+    for title_id, title_data in _log_progress(titles):  # the number of titles is not known until they have all been read
+        if (trimmed := trim_title(title_data)) is not None:
+            yield title_id, trimmed
+
+
 if __name__ == "__main__":
     start_time = time.perf_counter()
     logging.info("[START] tiny.py started")
@@ -117,25 +410,38 @@ if __name__ == "__main__":
     # get the input_file file, output_file file and fields from the arguments
     titledb_path = args.input_file
     output_file = args.input_file if args.output_file is None else args.output_file
-    fields = VALID_FIELDS if args.fields is None else args.fields
+    fields = args.fields  # None keeps all fields
 
     # ensure the given fields are valid
     validate_fields(fields)
 
     # read the data from the input_file file
-    logging.info(f"Starting tiny.py with input file: {titledb_path}, output_file file: {output_file}, fields: {"All" if fields == VALID_FIELDS else fields}")
-    logging.info(f"Reading from {titledb_path}")
-    data = read_json_file(titledb_path)
-
-    start_size = os.path.getsize(titledb_path)
-    logging.info(f"Read {len(data)} titles from {titledb_path} ({start_size/1024/1024:.1f} MB)")
+    logging.info(f"Starting tiny.py with input file: {titledb_path}, output_file file: {output_file}, fields: {fields or "All"}")
+    logging.info(f"Using {JSON_LIBRARY} to parse and serialise JSON")
+    if args.stream:
+        # trim each title as it is read and write it straight to the output_file file
+        titles = stream_json_file(titledb_path)
+
+        start_size = os.path.getsize(titledb_path)
+        logging.info(f"Streaming from {titledb_path} ({start_size/1024/1024:.1f} MB) to {output_file}")
+        count = write_titles_to_file(output_file, trim_titles(titles, fields))
+        logging.info(f"Wrote {count} titles to {output_file}")
+    else:
+        logging.info(f"Reading from {titledb_path}")
+        data = read_json_file(titledb_path)
+
+        start_size = os.path.getsize(titledb_path)
+        logging.info(f"Read {len(data)} titles from {titledb_path} ({start_size/1024/1024:.1f} MB)")
+
+        # trim the data, in place if it is going to overwrite the input_file file anyway so only one copy is held in memory
+        if os.path.abspath(output_file) == os.path.abspath(titledb_path):
+            new_data = trim_titledb_in_place(data, fields)
+        else:
+            new_data = trim_titledb(data, fields)
 
-    # trim the data
-    new_data = trim_titledb(data, fields)
-
-    # write the new data to the output_file file
-    logging.info(f"Writing {len(new_data)} titles to {output_file}")
-    write_to_file(output_file, new_data)
+        # write the new data to the output_file file
+        logging.info(f"Writing {len(new_data)} titles to {output_file}")
+        write_titles_to_file(output_file, new_data)
 
     logging.info(f"tiny.py completed in {(time.perf_counter() - start_time):.4f} seconds and reduced the file size by {(((start_size - os.path.getsize(output_file)) / start_size) * 100):.1f}% from {
                  (start_size/1024/1024):.1f} MB to {(os.path.getsize(output_file)/1024/1024):.1f} MB.")